@@ -1,15 +1,17 @@
 import argparse
+import asyncio
 import datetime
-import json
 import logging
-import os
-import threading
+import queue
+import random
+import signal
 import time
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 
-import requests
-from dateutil import parser
+import aiohttp
+import orjson
 
 from booking_user import BookingUser
 
@@ -20,17 +22,24 @@ offsets = {
     'tennisClass': 835
 }
 
+_now = datetime.datetime.now
+# elapsed times are measured on the monotonic clock so wall clock changes don't affect them
+_monotonic = time.monotonic
 
-def init_logger(name, filename):
+
+def init_logger(name, filename, log_queue):
+    # the logger only enqueues records, the returned file handler must be served by a QueueListener
     logger = logging.getLogger(name)
     logger.setLevel(logging.INFO)
+    logger.addHandler(QueueHandler(log_queue))
+
     fh = logging.FileHandler(filename, mode='a')
     fh.setLevel(logging.INFO)
+    fh.addFilter(logging.Filter(name))
 
     formatter = logging.Formatter('[%(asctime)s] %(levelname)s  %(message)s', datefmt="%Y-%m-%d %H:%M:%S")
     fh.setFormatter(formatter)
-    logger.addHandler(fh)
-    return logger
+    return logger, fh
 
 
 class BookingSystem:
@@ -38,123 +47,188 @@ class BookingSystem:
         self.base_url = base_url
         self.user = BookingUser(base_url, class_type, user_info, logger)
         self.logger = logger
+        self._stop = asyncio.Event()
+
+    def stop(self):
+        self._stop.set()
+
+    async def _sleep(self, secs: float) -> bool:
+        # sleep that wakes up early when the system is stopped, returns True in that case
+        try:
+            await asyncio.wait_for(self._stop.wait(), timeout=secs)
+            return True
+        except asyncio.TimeoutError:
+            return False
 
-    def enforce_auth(self):
+    async def enforce_auth(self):
         while True:
             try:
-                self.user.auth()
-                self.user.me()
-                self.logger.info(f"Authentication success")
+                await self.user.auth()
+                await self.user.me()
+                self.logger.info("Authentication success")
                 break
-            except requests.exceptions.HTTPError:
-                self.logger.error(f"Authentication failed for user {self.user.name}. Sleeping 30 mins")
-                time.sleep(1800)
+            except aiohttp.ClientResponseError:
+                self.logger.error("Authentication failed for user %s. Sleeping 30 mins", self.user.name)
+                if await self._sleep(1800):
+                    break
 
-    def search_target_date(self, target_last_date: str):
-        self.logger.info(f"Start searching for date {target_last_date}")
-        start = time.time()
+    async def search_target_date(self, target_last_date: str) -> Optional[List[Dict[str, Any]]]:
+        # returns the class listing in which the target date was found, None if stopped before
+        self.logger.info("Start searching for date %s", target_last_date)
+        start = _monotonic()
 
-        while True:
+        while not self._stop.is_set():
             try:
-                last_dates_available = []
-                url = os.path.join(self.base_url, self.user.classes_url, self.user.class_type)
-                r = requests.get(url, headers=self.user.headers, timeout=self.user.timeout)
-                r.raise_for_status()
+                classes = await self.user.get_class_listing()
+                # the listing ids are ISO dates, their first 10 characters are the day
+                last_date = classes[-1]["_id"][:10]
 
-                classes = r.json()
-                last_date = parser.parse(classes[-1]["_id"])
-                last_dates_available.append(datetime.datetime.strftime(last_date, "%Y-%m-%d"))
-
-                dt = datetime.datetime.now()
-                if target_last_date in last_dates_available:
+                dt = _now()
+                if last_date == target_last_date:
                     self.logger.info("Found target date")
-                    break
+                    return classes
                 else:
                     next_time = datetime.datetime.combine(dt, datetime.time(hour=dt.hour + 1))
                     diff = (next_time - dt)
                     secs = diff.total_seconds()
-                    self.logger.info(f"Target date not available. Sleeping {secs} seconds.")
+                    self.logger.info("Target date not available. Sleeping %s seconds.", secs)
 
-                    end = time.time()
+                    end = _monotonic()
                     if end - start >= 10800:
                         self.logger.info("Re-auth: 3 hours have passed since we started searching for the target date")
-                        self.enforce_auth()
-                        start = time.time()
-                    time.sleep(secs)
-            except requests.exceptions.HTTPError:
+                        await self.enforce_auth()
+                        start = _monotonic()
+                    if await self._sleep(secs):
+                        break
+            except aiohttp.ClientResponseError:
                 self.logger.error("Connection error searching for date. Sleeping 30min.")
-                time.sleep(1800)
-                self.enforce_auth()
+                if await self._sleep(1800):
+                    break
+                await self.enforce_auth()
 
-    def do_bookings(self, classes_to_schedule: List[Dict[str, Any]]):
+    async def do_bookings(self, classes_to_schedule: List[Dict[str, Any]]):
         for class_candidate in classes_to_schedule:
-            day = parser.parse(class_candidate["classDate"]).strftime("%Y-%m-%d")
-            self.user.book_class(class_candidate["_id"])
-            self.logger.info(f"Booked class for {day} at {class_candidate['classTime']}")
-
-    def crawler(self, candidates, tomorrow):
-        dt = datetime.datetime.now()
-        start_logging = time.time()
+            # get_classes_to_schedule has already cut classDate down to the day
+            day = class_candidate["classDate"]
+            await self.user.book_class(class_candidate["_id"])
+            self.logger.info("Booked class for %s at %s", day, class_candidate['classTime'])
+
+    async def crawler(self, candidates, tomorrow):
+        dt = _now()
+        start_logging = _monotonic()
+        # poll interval grows while nothing frees up and resets as soon as something gets booked
+        backoff = 60
         self.logger.info("Crawler started")
 
-        while dt < tomorrow and len(candidates) > 0:
+        while dt < tomorrow and candidates and not self._stop.is_set():
             try:
-                classes_to_schedule, candidates = self.user.get_classes_to_schedule(candidates)
-                if len(classes_to_schedule) > 0:
-                    self.do_bookings(classes_to_schedule)
+                classes_to_schedule, candidates = await self.user.get_classes_to_schedule(candidates)
+                if classes_to_schedule:
+                    await self.do_bookings(classes_to_schedule)
+                    backoff = 60
+                else:
+                    backoff = min(backoff * 1.5, 300)
 
-                end_logging = time.time()
+                end_logging = _monotonic()
                 if (end_logging - start_logging) // 3600 > 0:
-                    self.logger.info(f"After 1h there are still classes not found. Continue searching for {candidates}")
-                    start_logging = time.time()
-
-                time.sleep(60)
-                dt = datetime.datetime.now()
-            except (
-                    requests.exceptions.ConnectionError, requests.exceptions.ReadTimeout,
-                    requests.exceptions.HTTPError):
+                    self.logger.info("After 1h there are still classes not found. Continue searching for %s",
+                                     candidates)
+                    start_logging = _monotonic()
+
+                if await self._sleep(backoff + random.random() * 5):
+                    break
+                dt = _now()
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError, aiohttp.ClientResponseError):
                 self.logger.error("Time out or connection error detected, sleeping 10 minutes")
-                time.sleep(600)
-                self.enforce_auth()
+                if await self._sleep(600):
+                    break
+                await self.enforce_auth()
                 continue
 
         self.logger.info("Stopping crawler")
 
-    def run(self, offset_tomorrow: int):
-        while True:
-            try:
-                dt = datetime.datetime.now()
-                tomorrow = datetime.datetime.combine(dt + datetime.timedelta(days=1), datetime.time.min)
-                tomorrow = tomorrow + datetime.timedelta(minutes=offset_tomorrow)
-                target_last_date = dt + datetime.timedelta(days=7)
-                target_last_date = datetime.datetime.strftime(target_last_date, "%Y-%m-%d")
-                days_crawler = [datetime.datetime.strftime(dt, "%Y-%m-%d"),
-                                datetime.datetime.strftime(tomorrow, "%Y-%m-%d")]
-
-                self.enforce_auth()
-                candidates = self.user.generate_candidates()
-                self.search_target_date(target_last_date)
-                classes_to_schedule, candidates_not_available = self.user.get_classes_to_schedule(candidates)
-
-                if len(classes_to_schedule) > 0:
-                    self.do_bookings(classes_to_schedule)
-                if len(candidates_not_available) > 0:
-                    self.logger.info(f"There are candidates not available: {candidates}")
-                    candidates_not_available = [c for c in candidates_not_available if c[0] in days_crawler]
-                    if len(candidates_not_available) > 0:
-                        self.logger.info(f"Running crawler for {candidates_not_available}")
-                        self.crawler(candidates_not_available, tomorrow)
-
-                dt = datetime.datetime.now()
-                if dt < tomorrow:
-                    time_until_tomorrow = tomorrow - dt
-                    self.logger.info(
-                        f"There are no candidates to book - sleep {time_until_tomorrow} until next day")
-                    time.sleep(time_until_tomorrow.seconds)
-            except Exception as e:
-                self.logger.exception(e)
-                time.sleep(600)
-                continue
+    async def run(self, offset_tomorrow: int, connector: aiohttp.BaseConnector):
+        # the connection pool is shared with the other systems and owned by the caller
+        timeout = aiohttp.ClientTimeout(total=self.user.timeout)
+        async with aiohttp.ClientSession(connector=connector, connector_owner=False, timeout=timeout,
+                                         headers=self.user.initial_headers) as session:
+            self.user.session = session
+            while not self._stop.is_set():
+                try:
+                    dt = _now()
+                    tomorrow = datetime.datetime.combine(dt + datetime.timedelta(days=1), datetime.time.min)
+                    tomorrow = tomorrow + datetime.timedelta(minutes=offset_tomorrow)
+                    today = dt.date()
+                    target_last_date = (today + datetime.timedelta(days=7)).isoformat()
+                    days_crawler = {today.isoformat(), tomorrow.date().isoformat()}
+
+                    await self.enforce_auth()
+                    if self._stop.is_set():
+                        break
+                    candidates = await self.user.generate_candidates()
+                    bookings = await self.search_target_date(target_last_date)
+                    if self._stop.is_set():
+                        break
+                    classes_to_schedule, candidates_not_available = await self.user.get_classes_to_schedule(
+                        candidates, bookings)
+
+                    if classes_to_schedule:
+                        await self.do_bookings(classes_to_schedule)
+                    if candidates_not_available:
+                        self.logger.info("There are candidates not available: %s", candidates)
+                        candidates_not_available = [c for c in candidates_not_available if c[0] in days_crawler]
+                        if candidates_not_available:
+                            self.logger.info("Running crawler for %s", candidates_not_available)
+                            await self.crawler(candidates_not_available, tomorrow)
+
+                    dt = _now()
+                    if dt < tomorrow and not self._stop.is_set():
+                        time_until_tomorrow = tomorrow - dt
+                        self.logger.info(
+                            "There are no candidates to book - sleep %s until next day", time_until_tomorrow)
+                        await self._sleep(time_until_tomorrow.seconds)
+                except Exception as e:
+                    self.logger.exception(e)
+                    await self._sleep(600)
+                    continue
+
+        self.logger.info("Booking system stopped")
+
+
+async def main(contents):
+    systems = []
+    log_queue = queue.SimpleQueue()
+    file_handlers = []
+    logs_path = "users_data/logs"
+    Path(logs_path).mkdir(parents=True, exist_ok=True)
+    for user_data in contents:
+        for class_type in user_data["preferences"]:
+            logger_name = f"{user_data['name']}_{class_type}"
+            filename_log = f"{logs_path}/{logger_name}.log"
+            logger, fh = init_logger(logger_name, filename_log, log_queue)
+            file_handlers.append(fh)
+
+            booking_system = BookingSystem(website_base_url, class_type, user_data, logger)
+            systems.append((booking_system, offsets[class_type]))
+
+    def stop_all():
+        for bs, _ in systems:
+            bs.stop()
+
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop_all)
+
+    # a single thread writes the log files of all systems, so the event loop never blocks on them
+    listener = QueueListener(log_queue, *file_handlers, respect_handler_level=True)
+    listener.start()
+
+    # every system talks to the same backend, so they share one pool of keep-alive connections,
+    # idle connections outlive the crawler's longest backoff (300s plus jitter) so they get reused
+    connector = aiohttp.TCPConnector(limit=32, keepalive_timeout=330)
+    try:
+        await asyncio.gather(*(bs.run(offset, connector) for bs, offset in systems))
+    finally:
+        await connector.close()
+        listener.stop()
 
 
 if __name__ == '__main__':
@@ -163,17 +237,7 @@ if __name__ == '__main__':
     args = p.parse_args()
 
     config_path = args.config
-    with open(config_path, 'r') as j:
-        contents = json.loads(j.read())
+    with open(config_path, 'rb') as j:
+        contents = orjson.loads(j.read())
 
-    for user_data in contents:
-        for class_type, class_data in user_data["preferences"].items():
-            logs_path = f"users_data/logs"
-            Path(logs_path).mkdir(parents=True, exist_ok=True)
-            logger_name = f"{user_data['name']}_{class_type}"
-            filename_log = f"{logs_path}/{logger_name}.log"
-            logger = init_logger(logger_name, filename_log)
-
-            booking_system = BookingSystem(website_base_url, class_type, user_data, logger)
-            process = threading.Thread(target=booking_system.run, args=(offsets[class_type],))
-            process.start()
+    asyncio.run(main(contents))
@@ -1,11 +1,36 @@
 import datetime
-import os
-from typing import Dict, List, Any, Tuple, Union
+import functools
+import itertools
+import re
+from typing import Dict, List, Any, Tuple, Union, Optional
 
-import requests
-from dateutil import parser
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
+import aiohttp
+import orjson
+
+# preferences name days in English, unlike strftime("%A") these don't depend on the locale
+_WEEKDAYS = ("Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday")
+_HOUR_RE = re.compile(r"\s*(\d{1,2}):(\d{2})\s*([ap]m)", re.IGNORECASE)
+
+
+@functools.lru_cache(maxsize=128)
+def _weekday_of(day: str) -> str:
+    return _WEEKDAYS[datetime.date.fromisoformat(day).weekday()]
+
+
+@functools.lru_cache(maxsize=256)
+def _parse_hour(hour_minutes: str) -> datetime.timedelta:
+    # class times come from a few dozen "h:mm am/pm" strings, so each is only parsed once
+    match = _HOUR_RE.match(hour_minutes)
+    if match is None:
+        raise ValueError(f"Unexpected class time {hour_minutes!r}")
+    hour_int = int(match[1])
+    minutes_int = int(match[2])
+
+    time_of_day = match[3].lower()
+    if time_of_day == 'pm' and hour_int < 12:
+        hour_int = hour_int + 12
+
+    return datetime.timedelta(hours=hour_int, minutes=minutes_int)
 
 
 class BookingUser:
@@ -18,177 +43,164 @@ class BookingUser:
         self.user_preferences = user_info["preferences"][self.class_type]
         self.auth_url = "auth/local"
         self.classes_url = "api/class/gym/5fd7cff72eb93d371e0aa7de"
-        self.headers = {"Content-Type": "application/json"}
+        # full urls are built once, the per class ones only append ids to self._base
+        self._base = base_url.rstrip('/')
+        self._auth_full_url = f"{self._base}/{self.auth_url}"
+        self._me_url = f"{self._base}/api/users/me"
+        self._upcoming_url = f"{self._base}/api/users/{class_type}/upcoming"
+        self.class_listing_url = f"{self._base}/{self.classes_url}/{class_type}"
+        # only seeds the session's default headers, the bearer token is set on session.headers by auth()
+        self.initial_headers = {"Content-Type": "application/json"}
         self.timeout = 5.0
         self.user_id = None
+        # encoded request bodies bound to user_id, built once by me()
+        self._book_body = None
+        self._cancel_body = None
         self.logger = logger
+        # set by the owning BookingSystem once the event loop is running
+        self.session: Optional[aiohttp.ClientSession] = None
 
-    def get_scheduled_classes(self) -> List[Dict[str, Any]]:
+    async def get_scheduled_classes(self) -> List[Dict[str, Any]]:
         # return scheduled classes for a given user
         booked_classes = []
-        url = os.path.join(self.base_url, f"api/users/{self.class_type}/upcoming")
-        r = requests.get(url, headers=self.headers, timeout=self.timeout)
-        r.raise_for_status()
-
-        for booked_class in r.json():
+        for booked_class in await self._get_json(self._upcoming_url):
             if booked_class["status"] == "active":
                 class_tmp = dict()
                 class_tmp["booking_id"] = booked_class["_id"]
                 booked_class = booked_class['class']
                 class_tmp["class_id"] = booked_class["_id"]
-                day = parser.parse(booked_class["classDate"])
-                class_tmp["classDate"] = (day.strftime("%Y-%m-%d"), day.strftime("%A"))
+                day = booked_class["classDate"][:10]
+                class_tmp["classDate"] = (day, _weekday_of(day))
                 class_tmp["classTime"] = booked_class["classTime"]
                 booked_classes.append(class_tmp)
 
         return booked_classes
 
-    def generate_candidates(self) -> List[Tuple[Union[str, List[str]]]]:
+    async def get_class_listing(self) -> List[Dict[str, Any]]:
+        # classes of the coming days for this class type, grouped by day
+        return await self._get_json(self.class_listing_url)
+
+    async def generate_candidates(self) -> List[Tuple[Union[str, List[str]]]]:
         # returns the classes that the user wants to book: has preference AND it is not in its list of scheduled class
         ndays = 8
-        candidate_days = self._generate_candidate_days(ndays)
-        scheduled_classes = self.get_scheduled_classes()
-        candidates = self._filter_days_to_schedule(candidate_days, scheduled_classes)
+        now = datetime.datetime.now()
+        candidate_days = self._generate_candidate_days(ndays, now)
+        scheduled_classes = await self.get_scheduled_classes()
+        candidates = self._filter_days_to_schedule(candidate_days, scheduled_classes, now)
 
         return candidates
 
-    def get_classes_to_schedule(self, candidates_class: List[Tuple[Union[str, List[str]]]]) -> Tuple[
-                                List[Dict[str, Any]], List[Tuple[Union[str, List[str]]]]]:
+    async def get_classes_to_schedule(self, candidates_class: List[Tuple[Union[str, List[str]]]],
+                                      bookings: Optional[List[Dict[str, Any]]] = None) -> Tuple[
+                                      List[Dict[str, Any]], List[Tuple[Union[str, List[str]]]]]:
         # receives the candidates already filtered by the user preferences and filtered by what we already scheduled
         # it then searches for availability for those candidates, if found returns that class information
-        url = os.path.join(self.base_url, self.classes_url, self.class_type)
-
-        s = requests.Session()
-        retries = Retry(total=5, backoff_factor=1, status_forcelist=[ 502, 503, 504 ])
-        s.mount('http://', HTTPAdapter(max_retries=retries))
-
-        r = s.get(url, headers=self.headers, timeout=self.timeout)
-        r.raise_for_status()
-        bookings = r.json()
-
-        days_to_filter = [d[0] for d in candidates_class]
-        filtered_bookings = {}
+        # a class listing that was just fetched can be passed in to avoid downloading it again
+        if bookings is None:
+            bookings = await self.get_class_listing()
+
+        days_to_filter = {d[0] for d in candidates_class}
+        # ids and class dates start with the YYYY-MM-DD day, no need to parse them
+        filtered_bookings = {b["_id"][:10]: b for b in bookings if b["_id"][:10] in days_to_filter}
+        # index the listed classes by (day, time) slot once, so each candidate is a single lookup
+        classes_by_slot = {}
+        for day, b in filtered_bookings.items():
+            for real_class in b["classes"]:
+                classes_by_slot.setdefault((day, _parse_hour(real_class["classTime"])), []).append(real_class)
         classes_to_schedule = []
-        candidates_scheduled = []
-        for b in bookings:
-            d = parser.parse(b["_id"]).strftime("%Y-%m-%d")
-            if d in days_to_filter:
-                filtered_bookings[d] = b
+        # candidates hold a list so they can't go in a set, their positions can
+        scheduled_idx = set()
 
-        for candidate in candidates_class:
+        for i, candidate in enumerate(candidates_class):
             day = candidate[0]
-            candidate_time = self._parse_hour(candidate[2])
+            candidate_time = _parse_hour(candidate[2])
             required_spots = 1 + len(candidate[3])
 
-            if day in filtered_bookings.keys():
-                for real_class in filtered_bookings[day]["classes"]:
-                    available_spots = real_class["limit"] - real_class["joinedUsers"]
-                    real_class_time = self._parse_hour(real_class["classTime"])
-                    if real_class_time > candidate_time:
+            for real_class in classes_by_slot.get((day, candidate_time), ()):
+                available_spots = real_class["limit"] - real_class["joinedUsers"]
+                cancel = False
+                for attendance in real_class["attendanceList"]:
+                    if attendance["user"] == self.user_id and attendance["status"] == "cancelled":
+                        self.logger.info(
+                            "The %s for %s at %s was cancelled by user - remove from scheduling",
+                            self.class_type, day, candidate[2])
+                        cancel = True
+                        scheduled_idx.add(i)
                         break
 
-                    if real_class_time == candidate_time:
-                        cancel = False
-                        for attendance in real_class["attendanceList"]:
-                            if attendance["user"] == self.user_id and attendance["status"] == "cancelled":
-                                self.logger.info(
-                                    f"The {self.class_type} for {day} at {candidate[2]} "
-                                    f"was cancelled by user - remove from scheduling")
-                                cancel = True
-                                candidates_scheduled.append(candidate)
-                                break
-
-                        if not real_class["active"]:
-                            self.logger.info(f"The {self.class_type} for {day} at {candidate[2]} is not active - skip")
-                            candidates_scheduled.append(candidate)
-
-                        if not cancel and available_spots >= required_spots and real_class["active"]:
-                            real_class["classDate"] = parser.parse(real_class["classDate"]).strftime("%Y-%m-%d")
-                            classes_to_schedule.append(real_class)
-                            candidates_scheduled.append(candidate)
-
-        candidates_not_available = [c for c in candidates_class if c not in candidates_scheduled]
+                if not real_class["active"]:
+                    self.logger.info("The %s for %s at %s is not active - skip",
+                                     self.class_type, day, candidate[2])
+                    scheduled_idx.add(i)
+
+                if not cancel and available_spots >= required_spots and real_class["active"]:
+                    real_class["classDate"] = real_class["classDate"][:10]
+                    classes_to_schedule.append(real_class)
+                    scheduled_idx.add(i)
+
+        candidates_not_available = [c for i, c in enumerate(candidates_class) if i not in scheduled_idx]
         return classes_to_schedule, candidates_not_available
 
-    def book_class(self, class_id: str):
-        url = os.path.join(self.base_url, "api/class", class_id)
-        data = f'{{"userId":"{self.user_id}","isSinglePayment":true}}'
-        r = requests.post(url, headers=self.headers, data=data, timeout=self.timeout)
-        r.raise_for_status()
+    async def book_class(self, class_id: str):
+        url = f"{self._base}/api/class/{class_id}"
+        async with self.session.post(url, data=self._book_body) as r:
+            r.raise_for_status()
 
-    def cancel_class(self, booking_id: str):
-        url = os.path.join(self.base_url, "api/attendance", booking_id, "cancel")
-        data = f'{{"userId":"{self.user_id}"}}'
-        r = requests.patch(url, headers=self.headers, data=data, timeout=self.timeout)
-        r.raise_for_status()
+    async def cancel_class(self, booking_id: str):
+        url = f"{self._base}/api/attendance/{booking_id}/cancel"
+        async with self.session.patch(url, data=self._cancel_body) as r:
+            r.raise_for_status()
 
     @staticmethod
-    def _generate_candidate_days(ndays: int) -> Dict[str, List[str]]:
-        # return dict of weekday: [str_date] based on ndays
+    def _generate_candidate_days(ndays: int, now: datetime.datetime) -> Dict[str, List[str]]:
+        # return dict of weekday: [str_date] based on ndays from now
         candidate_days = {}
-        now = datetime.datetime.now()
         for i in range(ndays):
             day = now + datetime.timedelta(i)
-            weekday = day.strftime("%A")
-            if weekday in candidate_days:
-                candidate_days[weekday].append(day.strftime("%Y-%m-%d"))
-            else:
-                candidate_days[weekday] = [day.strftime("%Y-%m-%d")]
+            candidate_days.setdefault(_WEEKDAYS[day.weekday()], []).append(day.date().isoformat())
 
         return candidate_days
 
-    def _filter_days_to_schedule(self, candidate_days: Dict[str, List[str]],
-                                 scheduled_classes: List[Dict[str, Any]]) -> List[Tuple[Union[str, List[str]]]]:
+    def _filter_days_to_schedule(self, candidate_days: Dict[str, List[str]], scheduled_classes: List[Dict[str, Any]],
+                                 now: datetime.datetime) -> List[Tuple[Union[str, List[str]]]]:
         # filter days for each class regarding user preferences and classes already scheduled
         class_candidates = []
-        now = datetime.datetime.now()
 
         for day_p in self.user_preferences:
-            if day_p[0] in candidate_days.keys():
+            if day_p[0] in candidate_days:
                 class_dates = candidate_days[day_p[0]]
                 class_hours = day_p[1]
-                candidate = [(class_date, day_p[0], hour, day_p[2])
-                             for hour in class_hours for class_date in class_dates]
-                class_candidates.extend(candidate)
+                class_candidates.extend((class_date, day_p[0], hour, day_p[2])
+                                        for hour, class_date in itertools.product(class_hours, class_dates))
 
         # after filtering candidates using the preferences, filter the ones already scheduled
         filtered_candidates = []
+        scheduled_days = {(day["classDate"][0], _parse_hour(day["classTime"].lower())) for day in
+                          scheduled_classes}
         for candidate in class_candidates:
-            scheduled_days = {(day["classDate"][0], self._parse_hour(day["classTime"].lower())) for day in
-                              scheduled_classes}
             candidate_date = candidate[0]
-            candidate_hour = self._parse_hour(candidate[2])
-            preference_datetime = parser.parse(candidate_date) + candidate_hour
-
+            candidate_hour = _parse_hour(candidate[2])
+            preference_datetime = datetime.datetime.fromisoformat(candidate_date) + candidate_hour
 
             if now < preference_datetime and (candidate_date, candidate_hour) not in scheduled_days:
                 filtered_candidates.append(candidate)
 
         return filtered_candidates
 
-    def me(self):
-        url = os.path.join(self.base_url, "api/users/me")
-        r = requests.get(url, headers=self.headers, timeout=self.timeout)
-        r.raise_for_status()
-        response = r.json()
+    async def me(self):
+        response = await self._get_json(self._me_url)
         self.user_id = response["_id"]
-
-    def auth(self):
-        url = os.path.join(self.base_url, self.auth_url)
-        data = f'{{"email":"{self.user_email}","password":"{self.password}"}}'
-        r = requests.post(url, headers=self.headers, data=data, timeout=self.timeout)
-        r.raise_for_status()
-        response = r.json()
-        self.headers["Authorization"] = f"Bearer {response['token']}"
-
-    @staticmethod
-    def _parse_hour(hour_minutes: str):
-        hour = hour_minutes.split()
-        hour_int = int(hour[0].split(":")[0])
-        minutes_int = int(hour[0].split(":")[1])
-
-        time_of_day = hour[1].lower()
-        if time_of_day == 'pm' and hour_int < 12:
-            hour_int = hour_int + 12
-
-        return datetime.timedelta(hours=hour_int, minutes=minutes_int)
+        self._book_body = orjson.dumps({"userId": self.user_id, "isSinglePayment": True})
+        self._cancel_body = orjson.dumps({"userId": self.user_id})
+
+    async def auth(self):
+        data = {"email": self.user_email, "password": self.password}
+        async with self.session.post(self._auth_full_url, json=data) as r:
+            r.raise_for_status()
+            response = orjson.loads(await r.read())
+        self.session.headers["Authorization"] = f"Bearer {response['token']}"
+
+    async def _get_json(self, url: str) -> Any:
+        async with self.session.get(url) as r:
+            r.raise_for_status()
+            return orjson.loads(await r.read())